@@ -1,9 +1,14 @@
 # app.py
 import json
+import mmap
 import re
+import zlib
+from array import array
+from collections import Counter
 from pathlib import Path
 
 import numpy as np
+import orjson
 import requests
 import faiss
 import streamlit as st
@@ -16,21 +21,109 @@ import plotly.express as px
 WORD_RE = re.compile(r"[A-Za-zÁÉÍÓÚÜÑáéíóúüñ0-9]{3,}")
 
 
-def load_meta(meta_path: Path):
-    rows = []
-    with meta_path.open("r", encoding="utf-8") as f:
+def build_meta_offsets(meta_path: Path) -> np.ndarray:
+    """
+    offsets[i] = byte donde empieza la fila i de meta.jsonl (int64[N+1]).
+    Se guarda en meta.offsets.npy y se regenera si meta.jsonl es más nuevo.
+    """
+    off_path = meta_path.with_suffix(".offsets.npy")
+    if off_path.exists() and off_path.stat().st_mtime >= meta_path.stat().st_mtime:
+        return np.load(off_path)
+
+    # una pasada en streaming: memoria O(filas), no O(bytes del archivo)
+    starts = array("q")
+    pos = 0
+    with meta_path.open("rb") as f:
         for line in f:
-            if line.strip():
-                rows.append(json.loads(line))
-    return rows
+            if line.strip():  # ignora líneas vacías o solo con espacios (como el load_meta anterior)
+                starts.append(pos)
+            pos += len(line)
+    offsets = np.append(np.frombuffer(starts, dtype=np.int64), pos)
 
+    try:
+        np.save(off_path, offsets)
+    except OSError:
+        pass  # dir de solo lectura: se recalcula en el próximo arranque
+    return offsets
 
-def ollama_embed_one(text: str, model: str, host: str) -> np.ndarray:
+
+class MetaView:
+    """Acceso perezoso a meta.jsonl vía mmap: solo decodifica las filas pedidas."""
+
+    def __init__(self, meta_path: Path):
+        self.offsets = build_meta_offsets(meta_path)
+        self._f = meta_path.open("rb")
+        self._mm = mmap.mmap(self._f.fileno(), 0, access=mmap.ACCESS_READ) if len(self) else b""
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i: int) -> dict:
+        return orjson.loads(self._mm[self.offsets[i]:self.offsets[i + 1]])
+
+
+def ollama_embed_many(texts: list[str], model: str, host: str) -> np.ndarray:
+    # /api/embed acepta una lista en "input": un solo round trip para B textos
+    url = host.rstrip("/") + "/api/embed"
+    r = http_session().post(url, json={"model": model, "input": list(texts)}, timeout=120)
+    if r.status_code != 404:
+        r.raise_for_status()
+        data = r.json()
+        if "embeddings" in data:
+            return np.array(data["embeddings"], dtype="float32")  # (B, D)
+
+    # fallback (Ollama sin /api/embed): endpoint viejo, un request por texto
     url = host.rstrip("/") + "/api/embeddings"
-    r = requests.post(url, json={"model": model, "prompt": text}, timeout=120)
-    r.raise_for_status()
-    v = np.array(r.json()["embedding"], dtype="float32")
-    return v
+    vecs = []
+    for t in texts:
+        r = http_session().post(url, json={"model": model, "prompt": t}, timeout=120)
+        r.raise_for_status()
+        vecs.append(r.json()["embedding"])
+    return np.array(vecs, dtype="float32")
+
+
+def ollama_embed_one(text: str, model: str, host: str) -> np.ndarray:
+    return ollama_embed_many([text], model, host)[0]
+
+
+def apply_search_params(index, index_dir: Path) -> None:
+    # efSearch / nprobe guardados (o autoajustados) por embed_faiss.py en params.json
+    p = index_dir / "params.json"
+    if not p.exists():
+        return
+    params = json.loads(p.read_text(encoding="utf-8")).get("search_params")
+    if params:
+        faiss.ParameterSpace().set_index_parameters(index, params)
+
+
+def set_nprobe(index, nprobe: int) -> None:
+    # solo aplica a índices IVF (CPU o GPU); en índices planos no hace nada
+    spaces = [faiss.ParameterSpace()]
+    if hasattr(faiss, "GpuParameterSpace"):
+        spaces.append(faiss.GpuParameterSpace())
+    for ps in spaces:
+        try:
+            ps.set_index_parameter(index, "nprobe", nprobe)
+            return
+        except RuntimeError:
+            continue
+
+
+def binary_search(bindex, vecs: np.ndarray, v: np.ndarray, topk: int, metric: int):
+    """
+    Pre-rank por Hamming sobre códigos de signo (top 10*topk) y rerank con
+    los vectores float. Devuelve (D, I) con la misma convención que index.search.
+    """
+    _, cand = bindex.search(np.packbits(v > 0).reshape(1, -1), topk * 10)
+    cand = np.sort(cand[0][cand[0] >= 0])  # orden de disco: gather más barato en mmap
+    x = np.asarray(vecs[cand], dtype="float32")
+    if metric == faiss.METRIC_INNER_PRODUCT:
+        s = x @ v
+        order = np.argsort(-s)[:topk]
+    else:
+        s = ((x - v) ** 2).sum(axis=1)
+        order = np.argsort(s)[:topk]
+    return s[order][None, :], cand[order][None, :]
 
 
 def normalize(v: np.ndarray) -> np.ndarray:
@@ -38,9 +131,26 @@ def normalize(v: np.ndarray) -> np.ndarray:
     return v if n == 0 else (v / n)
 
 
-def keyword_hits(text: str, qwords: list[str]) -> int:
+def build_kw_automaton(qwords: list[str]):
+    # Aho-Corasick (pyahocorasick opcional): una pasada por texto, independiente de |qwords|
+    if not qwords:
+        return None
+    try:
+        import ahocorasick  # type: ignore
+    except Exception:
+        return None
+    A = ahocorasick.Automaton()
+    for w, c in Counter(qwords).items():
+        A.add_word(w, (w, c))
+    A.make_automaton()
+    return A
+
+
+def keyword_hits(text: str, qwords: list[str], automaton=None) -> int:
     t = text.lower()
-    return sum(1 for w in qwords if w in t)
+    if automaton is None:
+        return sum(1 for w in qwords if w in t)
+    return sum(c for _, c in {v for _, v in automaton.iter(t)})
 
 
 def read_text_if_exists(path_str: str, base_dir: str | None):
@@ -53,36 +163,111 @@ def read_text_if_exists(path_str: str, base_dir: str | None):
 
 
 # --- Dedup helpers (near-duplicates) ---
+# MinHash (128 permutaciones): cada resultado se compara contra todas las firmas ya
+# aceptadas en una sola operación vectorizada (K <= 80, no hace falta LSH)
+MINHASH_PERM = 128
+MINHASH_PRIME = (1 << 31) - 1  # a < 2^31, crc32 < 2^32 -> a*x+b cabe en uint64
+_mh_rng = np.random.default_rng(1)
+MINHASH_A = _mh_rng.integers(1, MINHASH_PRIME, size=MINHASH_PERM, dtype=np.uint64)
+MINHASH_B = _mh_rng.integers(0, MINHASH_PRIME, size=MINHASH_PERM, dtype=np.uint64)
+
+
 def norm_for_dedup(s: str) -> str:
     s = s.lower()
     s = re.sub(r"\s+", " ", s).strip()
     return s
 
 
-def shingles_words(text: str, k: int = 5) -> set:
-    w = norm_for_dedup(text).split()
-    if len(w) < k:
+def shingles_chars(text: str, k: int = 3) -> set:
+    # trigramas de caracteres: más estables que 5-gramas de palabras en snippets cortos
+    t = norm_for_dedup(text)
+    if len(t) < k:
         return set()
-    return set(tuple(w[i:i + k]) for i in range(len(w) - k + 1))
+    return {t[i:i + k] for i in range(len(t) - k + 1)}
+
+
+def minhash_signature(text: str, k: int = 3) -> np.ndarray | None:
+    sh = shingles_chars(text, k=k)
+    if not sh:
+        return None
+    hv = np.fromiter((zlib.crc32(x.encode("utf-8")) for x in sh), dtype=np.uint64, count=len(sh))
+    return ((MINHASH_A[:, None] * hv[None, :] + MINHASH_B[:, None]) % MINHASH_PRIME).min(axis=1)
 
 
-def jaccard(a: set, b: set) -> float:
-    if not a or not b:
-        return 0.0
-    inter = len(a & b)
-    union = len(a | b)
-    return inter / union if union else 0.0
+def minhash_signatures(texts: list[str]) -> tuple[np.ndarray, np.ndarray]:
+    # (K, MINHASH_PERM) uint64 + máscara de filas con shingles (las vacías nunca son duplicado)
+    sigs = np.zeros((len(texts), MINHASH_PERM), dtype=np.uint64)
+    valid = np.zeros(len(texts), dtype=bool)
+    for i, t in enumerate(texts):
+        sig = minhash_signature(t)
+        if sig is not None:
+            sigs[i] = sig
+            valid[i] = True
+    return sigs, valid
 
 
 # -----------------------------
 # Caches
 # -----------------------------
 @st.cache_resource
-def load_index_and_meta(index_dir: str):
+def http_session() -> requests.Session:
+    # keep-alive: reutiliza la conexión TCP con Ollama entre reruns
+    s = requests.Session()
+    s.headers["Connection"] = "keep-alive"
+    return s
+
+
+@st.cache_data(ttl=3600, max_entries=256)
+def cached_embed(q: str, model: str, host: str) -> np.ndarray:
+    # misma query/modelo/host -> no volver a llamar a Ollama en cada "Buscar"
+    return ollama_embed_one(q, model, host).astype("float32")
+
+
+@st.cache_data(max_entries=16)
+def load_report(path: str, mtime: float) -> dict:
+    # mtime es parte de la clave: si el reporte se regenera, se vuelve a leer
+    return json.loads(Path(path).read_text(encoding="utf-8"))
+
+
+@st.cache_resource
+def gpu_resources():
+    # un solo StandardGpuResources por proceso (no recrearlo en cada rerun)
+    return faiss.StandardGpuResources()
+
+
+def file_stamp(*paths: Path) -> tuple:
+    # (mtime_ns, size) por archivo: parte de la clave de cache, así un re-index en el mismo
+    # directorio invalida el índice/mmap cacheados (embed_faiss.py reescribe meta.jsonl in place)
+    return tuple((p.stat().st_mtime_ns, p.stat().st_size) if p.exists() else None for p in paths)
+
+
+@st.cache_resource(max_entries=4)
+def load_index_and_meta(index_dir: str, stamp: tuple):
     d = Path(index_dir)
     index = faiss.read_index(str(d / "faiss.index"))
-    meta = load_meta(d / "meta.jsonl")
-    return index, meta
+    apply_search_params(index, d)  # antes de clonar a GPU: nprobe se copia
+    try:
+        base_nprobe = faiss.extract_index_ivf(index).nprobe  # el de params.json (o del índice)
+    except RuntimeError:
+        base_nprobe = None  # no es IVF
+    if hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0:
+        try:
+            index = faiss.index_cpu_to_gpu(gpu_resources(), 0, index)
+        except RuntimeError:
+            pass  # tipos sin versión GPU (ej. SQ fp16/SQ8 sin IVF, HNSW): se queda en CPU
+    meta = MetaView(d / "meta.jsonl")
+    return index, meta, base_nprobe
+
+
+@st.cache_resource(max_entries=4)
+def load_binary_stage(index_dir: str, stamp: tuple):
+    # opcional: generado con embed_faiss.py --binary
+    d = Path(index_dir)
+    if not (d / "faiss.bindex").exists() or not (d / "vecs.npy").exists():
+        return None
+    bindex = faiss.read_index_binary(str(d / "faiss.bindex"))
+    vecs = np.load(d / "vecs.npy", mmap_mode="r")
+    return bindex, vecs
 
 
 # -----------------------------
@@ -97,6 +282,8 @@ with st.sidebar:
     idx_all = st.text_input("Ruta índice ALL", value="Francisco/docling_test5_all")
     use_hq = st.toggle("Usar HQ", value=True)
     index_dir = idx_hq if use_hq else idx_all
+    nprobe = st.slider("nprobe (solo índices IVF; 0 = el de params.json)", 0, 128, 0)
+    use_binary = st.toggle("Pre-rank binario (Hamming + rerank float)", value=False)
 
     st.divider()
     st.header("Embeddings")
@@ -133,17 +320,33 @@ with tab_query:
 
         if st.button("Buscar", type="primary"):
             try:
-                index, meta = load_index_and_meta(index_dir)
+                d = Path(index_dir)
+                index, meta, base_nprobe = load_index_and_meta(
+                    index_dir, file_stamp(d / "faiss.index", d / "meta.jsonl", d / "params.json")
+                )
             except Exception as e:
                 st.error(f"No pude cargar índice/meta desde: {index_dir}\n\n{e}")
                 st.stop()
+            # el índice cacheado se comparte entre reruns: volver al de params.json si el slider está en 0
+            if base_nprobe is not None:
+                set_nprobe(index, nprobe or base_nprobe)
 
             qwords = [w.lower() for w in WORD_RE.findall(q.lower())]
-            v = ollama_embed_one(q, emb_model, ollama_host)
+            kw_automaton = build_kw_automaton(qwords)
+            v = cached_embed(q, emb_model, ollama_host)
             if norm_query:
                 v = normalize(v)
 
-            D, I = index.search(v.reshape(1, -1), topk)
+            binary_stage = (
+                load_binary_stage(index_dir, file_stamp(d / "faiss.bindex", d / "vecs.npy")) if use_binary else None
+            )
+            if use_binary and binary_stage is None:
+                st.caption("No hay faiss.bindex/vecs.npy en el índice (embed_faiss.py --binary); uso búsqueda normal.")
+
+            if binary_stage is not None:
+                D, I = binary_search(*binary_stage, v.astype("float32"), topk, index.metric_type)
+            else:
+                D, I = index.search(v.reshape(1, -1), topk)
             D = D[0].tolist()
             I = I[0].tolist()
 
@@ -163,7 +366,7 @@ with tab_query:
                     "doc_path": doc_path,
                     "chunk_id": chunk_id,
                     "quality_score": m.get("quality_score", None),
-                    "hits": keyword_hits(text, qwords),
+                    "hits": keyword_hits(text, qwords, kw_automaton),
                     "snippet": (text[:320] + "…") if len(text) > 320 else text,
                     "_text_full": text,  # texto completo para dedup
                 })
@@ -183,31 +386,37 @@ with tab_query:
 
             # Dedup + límite por doc
             if dedup_on:
-                kept = []
-                kept_shingles = []
+                texts = [t or sn for t, sn in zip(df["_text_full"], df["snippet"])]
+                sigs, valid = minhash_signatures(texts)
+                docs = df["doc_path"].fillna("").to_numpy()
+
+                keep_pos = []
+                kept_sigs = np.empty_like(sigs)
+                n_kept_sigs = 0
                 per_doc = {}
 
-                for _, r in df.iterrows():
-                    doc = r.get("doc_path", "") or ""
+                for pos in range(len(df)):
+                    doc = docs[pos] or ""
                     per_doc[doc] = per_doc.get(doc, 0)
 
                     # límite de resultados por doc
                     if per_doc[doc] >= max_per_doc:
                         continue
 
-                    txt = r.get("_text_full", "") or r.get("snippet", "")
-                    sh = shingles_words(txt, k=5)
+                    # filtrar near-duplicates: todas las firmas ya aceptadas a la vez
+                    if valid[pos]:
+                        sig = sigs[pos]
+                        sim = (kept_sigs[:n_kept_sigs] == sig).mean(axis=1)
+                        if (sim >= dedup_thr).any():
+                            continue
 
-                    # filtrar near-duplicates
-                    too_similar = any(jaccard(sh, s2) >= dedup_thr for s2 in kept_shingles)
-                    if too_similar:
-                        continue
+                        kept_sigs[n_kept_sigs] = sig
+                        n_kept_sigs += 1
 
-                    kept.append(r)
-                    kept_shingles.append(sh)
+                    keep_pos.append(pos)
                     per_doc[doc] += 1
 
-                df = pd.DataFrame(kept)
+                df = df.iloc[keep_pos]
 
             # Limpia columnas internas (no mostrar _text_full)
             show_df = df.drop(columns=["_text_full"], errors="ignore")
@@ -250,7 +459,7 @@ with tab_analytics:
     try:
         p = Path(filter_report_path)
         if p.exists():
-            fr = json.loads(p.read_text(encoding="utf-8"))
+            fr = load_report(str(p), p.stat().st_mtime)
     except Exception:
         fr = None
 
@@ -1,15 +1,23 @@
 from __future__ import annotations
 
 import argparse
-import json
+import mmap
+import os
 import re
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from functools import lru_cache
 from pathlib import Path
-from typing import List, Tuple, Optional
+from typing import BinaryIO, Iterable, Iterator, List, Tuple
+
+import orjson
 
 
 # ----------------------------
 # Tokenizer (tiktoken optional)
 # ----------------------------
+@lru_cache(maxsize=None)
 def try_get_tiktoken(encoding_name: str):
     try:
         import tiktoken  # type: ignore
@@ -54,17 +62,47 @@ def chunk_by_paragraphs(
     """
     chunks: List[str] = []
     current: List[str] = []
+    current_ids: List[int] = []
     current_tokens = 0
 
-    for p in paragraphs:
-        p_tokens = count_tokens(p, enc)
+    # tokenizar cada párrafo una sola vez; los ids se reutilizan para cortes y overlap
+    # (loop simple: encode_ordinary_batch levanta un thread pool por llamada, más lento en docs chicos)
+    para_ids = None
+    sep_ids: List[int] = []
+    if enc is not None:
+        para_ids = [enc.encode_ordinary(p) for p in paragraphs]
+        sep_ids = enc.encode_ordinary("\n\n")
+
+    # Overlap entre chunks (solo si hay tiktoken). En fallback por palabras,
+    # ya hay overlap dentro de párrafos grandes; aquí lo dejamos simple.
+    with_overlap = enc is not None and overlap_tokens > 0
+    prev_tail_ids: List[int] = []
+
+    def emit(text: str, ids: List[int]) -> None:
+        # antepone el tail (en tokens) del chunk anterior; los ids ya se tienen,
+        # así que no hace falta re-tokenizar los chunks al final
+        nonlocal prev_tail_ids
+        if with_overlap and chunks:
+            prefix = enc.decode(prev_tail_ids).strip()
+            chunks.append((prefix + "\n" + text).strip() if prefix else text)
+        else:
+            chunks.append(text)
+        if with_overlap:
+            prev_tail_ids = ids[-overlap_tokens:]
+
+    def flush() -> None:
+        nonlocal current, current_ids, current_tokens
+        emit("\n\n".join(current).strip(), current_ids)
+        current, current_ids, current_tokens = [], [], 0
+
+    for k, p in enumerate(paragraphs):
+        p_tokens = len(para_ids[k]) if para_ids is not None else count_tokens(p, enc)
 
         # Si el párrafo solo ya excede el límite, cortarlo por tokens
         if p_tokens > max_tokens:
             # flush lo acumulado antes
             if current:
-                chunks.append("\n\n".join(current).strip())
-                current, current_tokens = [], 0
+                flush()
 
             if enc is None:
                 # fallback por palabras
@@ -72,50 +110,31 @@ def chunk_by_paragraphs(
                 i = 0
                 while i < len(words):
                     chunk_words = words[i:i + max_tokens]
-                    chunks.append(" ".join(chunk_words).strip())
+                    emit(" ".join(chunk_words).strip(), [])
                     i = max(i + max_tokens - overlap_tokens, i + 1)
             else:
-                ids = enc.encode(p)
+                ids = para_ids[k]
                 i = 0
                 while i < len(ids):
                     j = min(i + max_tokens, len(ids))
-                    chunks.append(enc.decode(ids[i:j]).strip())
+                    emit(enc.decode(ids[i:j]).strip(), ids[i:j])
                     i = max(j - overlap_tokens, i + 1)
 
             continue
 
         # Si agregar este párrafo excede, flush y empezar nuevo
         if current_tokens + p_tokens > max_tokens and current:
-            chunks.append("\n\n".join(current).strip())
-            current, current_tokens = [], 0
+            flush()
 
+        if para_ids is not None:
+            if current:
+                current_ids += sep_ids
+            current_ids += para_ids[k]
         current.append(p)
         current_tokens += p_tokens
 
     if current:
-        chunks.append("\n\n".join(current).strip())
-
-    # Overlap entre chunks (solo si hay tiktoken). En fallback por palabras,
-    # ya hay overlap dentro de párrafos grandes; aquí lo dejamos simple.
-    if enc is not None and overlap_tokens > 0 and len(chunks) > 1:
-        # reconstruye con overlap token-level para coherencia
-        rebuilt: List[str] = []
-        prev_tail_ids: List[int] = []
-
-        for idx, ch in enumerate(chunks):
-            ids = enc.encode(ch)
-            if idx == 0:
-                rebuilt.append(ch)
-            else:
-                # anteponer tail del chunk anterior
-                prefix = enc.decode(prev_tail_ids).strip()
-                if prefix:
-                    rebuilt.append((prefix + "\n" + ch).strip())
-                else:
-                    rebuilt.append(ch)
-            prev_tail_ids = ids[-overlap_tokens:] if len(ids) > overlap_tokens else ids
-
-        chunks = rebuilt
+        flush()
 
     return [c for c in chunks if c.strip()]
 
@@ -123,6 +142,31 @@ def chunk_by_paragraphs(
 # ----------------------------
 # IO
 # ----------------------------
+def read_text_mmap(path: Path) -> str:
+    # decodifica directo desde el mmap (sin copia intermedia a bytes)
+    with path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return ""
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return str(mm, "utf-8", "replace")
+
+
+def iter_texts(paths: Iterable[Path], workers: int = 4, prefetch: int = 16) -> Iterator[Tuple[Path, str]]:
+    """
+    Lee los archivos en threads mientras el hilo principal tokeniza.
+    Ventana acotada (prefetch) para no cargar todo el corpus en memoria.
+    """
+    it = iter(paths)
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        pending = deque((p, ex.submit(read_text_mmap, p)) for p, _ in zip(it, range(prefetch)))
+        while pending:
+            p, fut = pending.popleft()
+            nxt = next(it, None)
+            if nxt is not None:
+                pending.append((nxt, ex.submit(read_text_mmap, nxt)))
+            yield p, fut.result()
+
+
 def write_chunks_txt(out_dir: Path, rel_path: Path, chunks: List[str]) -> None:
     base = rel_path.with_suffix("")  # remove .txt
     target_dir = out_dir / base
@@ -132,16 +176,16 @@ def write_chunks_txt(out_dir: Path, rel_path: Path, chunks: List[str]) -> None:
         (target_dir / f"chunk_{i:04d}.txt").write_text(ch + "\n", encoding="utf-8")
 
 
-def append_chunks_jsonl(jsonl_path: Path, rel_path: Path, chunks: List[str]) -> None:
-    jsonl_path.parent.mkdir(parents=True, exist_ok=True)
-    with jsonl_path.open("a", encoding="utf-8") as f:
-        for i, ch in enumerate(chunks):
-            rec = {
-                "source_path": str(rel_path),
-                "chunk_index": i,
-                "text": ch
-            }
-            f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+def write_chunks_jsonl(fout: BinaryIO, rel_path: Path, chunks: List[str]) -> None:
+    # fout: un solo handle binario con buffer grande, abierto una vez en main
+    for i, ch in enumerate(chunks):
+        rec = {
+            "source_path": str(rel_path),
+            "chunk_index": i,
+            "text": ch
+        }
+        fout.write(orjson.dumps(rec))
+        fout.write(b"\n")
 
 
 def main():
@@ -154,6 +198,7 @@ def main():
     ap.add_argument("--overlap", type=int, default=80, help="Overlap entre chunks")
     ap.add_argument("--encoding", default="cl100k_base",
                     help="Encoding tiktoken (cl100k_base suele funcionar bien)")
+    ap.add_argument("--io_workers", type=int, default=4, help="Threads de lectura (I/O en paralelo a la tokenización)")
     args = ap.parse_args()
 
     in_dir = Path(args.in_dir)
@@ -162,26 +207,22 @@ def main():
 
     enc = try_get_tiktoken(args.encoding)
 
-    jsonl_path: Optional[Path] = None
-    if args.format == "jsonl":
-        jsonl_path = out_dir / "chunks.jsonl"
-        if jsonl_path.exists():
-            jsonl_path.unlink()  # rehacer limpio
-
     txt_files = list(in_dir.rglob("*.md"))
     print(f"Encontrados {len(txt_files)} txts en {in_dir}")
 
-    for p in txt_files:
-        rel = p.relative_to(in_dir)
-        raw = p.read_text(encoding="utf-8", errors="replace")
+    # jsonl: se reescribe limpio y se mantiene abierto durante todo el run
+    fout = (out_dir / "chunks.jsonl").open("wb", buffering=1 << 20) if args.format == "jsonl" else nullcontext()
+    with fout:
+        for p, raw in iter_texts(txt_files, workers=args.io_workers):
+            rel = p.relative_to(in_dir)
 
-        paras = split_paragraphs(raw)
-        chunks = chunk_by_paragraphs(paras, args.max_tokens, args.overlap, enc)
+            paras = split_paragraphs(raw)
+            chunks = chunk_by_paragraphs(paras, args.max_tokens, args.overlap, enc)
 
-        if args.format == "txt":
-            write_chunks_txt(out_dir, rel, chunks)
-        else:
-            append_chunks_jsonl(jsonl_path, rel, chunks)
+            if args.format == "txt":
+                write_chunks_txt(out_dir, rel, chunks)
+            else:
+                write_chunks_jsonl(fout, rel, chunks)
 
     print("OK. Chunks guardados en:", out_dir)
 
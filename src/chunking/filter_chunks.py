@@ -2,12 +2,62 @@ from __future__ import annotations
 import json
 import re
 import hashlib
+import os
+import sys
+import unicodedata
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
-from collections import Counter, defaultdict
+from collections import Counter
 
-LETTER_RE = re.compile(r"[A-Za-zÁÉÍÓÚÜÑáéíóúüñ]")
-DIGIT_RE  = re.compile(r"\d")
-SPACE_RE  = re.compile(r"\s")
+import numpy as np
+import orjson
+
+# clasificador por byte: una sola pasada vectorizada en vez de 3 regex
+CLS_LETTER, CLS_DIGIT, CLS_SPACE = 1, 2, 4
+
+BYTE_CLASS = np.zeros(256, dtype=np.uint8)
+BYTE_CLASS[np.frombuffer(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz", np.uint8)] = CLS_LETTER
+BYTE_CLASS[np.frombuffer(b"0123456789", np.uint8)] = CLS_DIGIT
+BYTE_CLASS[np.frombuffer(b" \t\n\r\x0b\x0c\x1c\x1d\x1e\x1f", np.uint8)] = CLS_SPACE
+
+# acentos -> proxy ASCII (1 char = 1 byte), espacios unicode -> " ", dígitos unicode (Nd) -> "0"
+# (mismos conteos que los regex anteriores: \d y \s matchean también fuera de ASCII)
+ASCII_PROXY = str.maketrans({
+    **{c: "a" for c in "ÁÉÍÓÚÜÑáéíóúüñ"},
+    **{chr(c): "0" for c in range(128, sys.maxunicode + 1) if unicodedata.category(chr(c)) == "Nd"},
+    **{c: " " for c in "\x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004\u2005\u2006"
+                       "\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000"},
+})
+
+# razones de descarte como bits de un uint16: en el loop solo hay OR de enteros
+EMPTY            = 1 << 0
+DIGIT_HEAVY      = 1 << 1
+MANY_SHORT_LINES = 1 << 2
+MANY_SEPARATORS  = 1 << 3
+PHONEISH         = 1 << 4
+PERCENT_DIGITS   = 1 << 5
+MONEY_DIGITS     = 1 << 6
+DUPLICATE        = 1 << 7
+TOO_SHORT        = 1 << 8
+BELOW_THRESHOLD  = 1 << 9
+EMPTY_LINE       = 1 << 10
+
+REASON_NAMES = {
+    EMPTY: "empty",
+    DIGIT_HEAVY: "digit_heavy",
+    MANY_SHORT_LINES: "many_short_lines",
+    MANY_SEPARATORS: "many_separators",
+    PHONEISH: "phoneish",
+    PERCENT_DIGITS: "percent+digits",
+    MONEY_DIGITS: "money+digits",
+    DUPLICATE: "duplicate",
+    TOO_SHORT: "too_short",
+    BELOW_THRESHOLD: "below_threshold",
+    EMPTY_LINE: "empty_line",
+}
+
+MASK_FLUSH = 1 << 16  # máscaras acumuladas antes de contarlas con NumPy
 
 # patrones comunes de “ruido estructural
 MANY_SEPARATORS_RE = re.compile(r"[-_=]{5,}|[|]{3,}")
@@ -25,11 +75,13 @@ def stats(text: str) -> dict:
             "lines": 0, "avg_line_len": 0.0, "short_lines_ratio": 1.0,
         }
 
-    alpha = len(LETTER_RE.findall(t))
-    digit = len(DIGIT_RE.findall(t))
-    space = len(SPACE_RE.findall(t))
+    b = np.frombuffer(t.translate(ASCII_PROXY).encode("utf-8", errors="ignore"), dtype=np.uint8)
+    counts = np.bincount(BYTE_CLASS[b], minlength=CLS_SPACE + 1)
+    alpha = int(counts[CLS_LETTER])
+    digit = int(counts[CLS_DIGIT])
+    space = int(counts[CLS_SPACE])
 
-    lines = [ln.strip() for ln in t.splitlines() if ln.strip()]
+    lines = [ln for ln in map(str.strip, t.splitlines()) if ln]
     num_lines = len(lines)
     avg_line_len = sum(len(ln) for ln in lines) / max(num_lines, 1)
     short_lines = sum(1 for ln in lines if len(ln) <= 20)
@@ -48,17 +100,18 @@ def stats(text: str) -> dict:
         "short_lines_ratio": short_lines_ratio,
     }
 
-def quality_score(s: dict, text: str) -> tuple[float, list[str]]:
+def quality_score(s: dict, text: str) -> tuple[float, int]:
     """
     Score 0..1. Heurística para embeddings:
     - premia texto con letras (contenido semántico)
     - penaliza muchos dígitos/separadores/listados
     - penaliza chunks con muchas líneas cortas (tablas/listas)
+    Devuelve (score, mask) con las razones como bits (ver REASON_NAMES).
     """
-    reasons = []
+    mask = 0
 
     if s["n"] == 0:
-        return 0.0, ["empty"]
+        return 0.0, EMPTY
 
     score = 0.0
 
@@ -68,28 +121,28 @@ def quality_score(s: dict, text: str) -> tuple[float, list[str]]:
     # penalizaciones
     if s["digit_ratio"] > 0.18:
         score -= (s["digit_ratio"] - 0.18) * 1.8
-        reasons.append("digit_heavy")
+        mask |= DIGIT_HEAVY
 
     if s["short_lines_ratio"] > 0.55 and s["lines"] >= 6:
         score -= (s["short_lines_ratio"] - 0.55) * 1.2
-        reasons.append("many_short_lines")
+        mask |= MANY_SHORT_LINES
 
     if MANY_SEPARATORS_RE.search(text):
         score -= 0.15
-        reasons.append("many_separators")
+        mask |= MANY_SEPARATORS
 
     # estas señales son típicas de anuncios/listados; no siempre, pero ayudan
     if PHONEISH_RE.search(text):
         score -= 0.10
-        reasons.append("phoneish")
+        mask |= PHONEISH
 
     if PERCENT_RE.search(text) and s["digit_ratio"] > 0.12:
         score -= 0.08
-        reasons.append("percent+digits")
+        mask |= PERCENT_DIGITS
 
     if MONEY_RE.search(text) and s["digit_ratio"] > 0.10:
         score -= 0.06
-        reasons.append("money+digits")
+        mask |= MONEY_DIGITS
 
     # clamp
     if score < 0:
@@ -97,52 +150,91 @@ def quality_score(s: dict, text: str) -> tuple[float, list[str]]:
     if score > 1:
         score = 1.0
 
-    return score, reasons
+    return score, mask
 
-def sha1_norm(text: str) -> str:
-    # normaliza espacios para dedup exacta “robusta”
-    t = re.sub(r"\s+", " ", text.strip())
-    return hashlib.sha1(t.encode("utf-8", errors="ignore")).hexdigest()
+def hash_norm(text: str) -> int:
+    # normaliza espacios para dedup exacta “robusta”; clave de 8 bytes (int) en vez de hex sha1
+    t = " ".join(text.split())
+    digest = hashlib.blake2b(t.encode("utf-8", errors="ignore"), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
 
-def main():
-    in_path = Path("Francisco/docling_test3/chunks.jsonl")
-    out_path = Path("Francisco/docling_test4/chunks_filtered.jsonl")
-    report_path = Path("Francisco/docling_test4/filter_report.json")
+def count_reason_bits(masks: list[int]) -> np.ndarray:
+    # (16,) conteo por bit: uint16 -> 2 bytes -> unpackbits en una sola pasada
+    m = np.asarray(masks, dtype="<u2")
+    bits = np.unpackbits(m.view(np.uint8).reshape(-1, 2), axis=1, bitorder="little")
+    return bits.sum(axis=0, dtype=np.int64)
 
-    # umbral por defecto (ajustable): 0.55 suele botar tablas/listados sin matar prosa
-    THRESH = 0.55
+def shard_bounds(path: Path, n_shards: int) -> list[tuple[int, int]]:
+    # rangos [start, end) de bytes, alineados a inicio de línea
+    size = path.stat().st_size
+    bounds = [0]
+    with path.open("rb") as f:
+        for k in range(1, n_shards):
+            f.seek(max(size * k // n_shards, bounds[-1]))
+            f.readline()  # avanzar hasta el próximo inicio de línea
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(a, b) for a, b in zip(bounds, bounds[1:]) if b > a]
 
-    seen_hashes = set()
-    kept = 0
+# candidatos por fila kept, en un sidecar binario junto al .partN (no viajan al padre como tuplas)
+CAND_DTYPE = np.dtype([("key", "<u8"), ("mask", "<u2"), ("score", "<f8"), ("doc", "<i4")])
+
+def iter_candidates(path: Path, block: int = MASK_FLUSH):
+    # (key, mask, score, doc) en bloques desde un memmap: memoria constante en el padre
+    if path.stat().st_size == 0:
+        return
+    cand = np.memmap(path, dtype=CAND_DTYPE, mode="r")
+    for i in range(0, len(cand), block):
+        yield from cand[i:i + block].tolist()
+    del cand
+
+def filter_shard(in_path: Path, start: int, end: int, tmp_path: Path, thresh: float) -> dict:
+    """
+    Filtra las líneas de [start, end). Dedup solo local: las filas que pasan
+    el filtro se escriben en tmp_path y sus (key, mask, score, doc) en un sidecar
+    (tmp_path + ".cand") para que main haga el dedup global en orden.
+    """
+    seen = {}  # key -> la primera aparición local fue descartada
+    docs = {}  # source_path -> id local (una entrada por doc, no por chunk)
+    cand_path = tmp_path.with_name(tmp_path.name + ".cand")
+    candidates = []
     dropped = 0
-    drop_reasons = Counter()
-    scores = []
-    per_doc_kept = defaultdict(int)
+    reason_bits = np.zeros(16, dtype=np.int64)
+    masks = []
+
+    with in_path.open("rb") as fin, tmp_path.open("wb") as fout, cand_path.open("wb") as fcand:
+        fin.seek(start)
+        pos = start
+        while pos < end:
+            line = fin.readline()
+            if not line:
+                break
+            pos += len(line)
 
-    with in_path.open("r", encoding="utf-8") as fin, out_path.open("w", encoding="utf-8") as fout:
-        for line_no, line in enumerate(fin, 1):
             line = line.strip()
             if not line:
                 dropped += 1
-                drop_reasons["empty_line"] += 1
+                masks.append(EMPTY_LINE)
                 continue
 
-            obj = json.loads(line)
+            obj = orjson.loads(line)
             text = obj.get("text", "")
             s = stats(text)
-            score, reasons = quality_score(s, text)
+            score, mask = quality_score(s, text)
 
-            h = sha1_norm(text)
-            is_dup = h in seen_hashes
-            if not is_dup:
-                seen_hashes.add(h)
+            key = hash_norm(text)
+            is_dup = key in seen
 
-            keep = (score >= THRESH) and (not is_dup) and (s["n"] >= 80)  # 80 chars mínimo
+            keep = (score >= thresh) and (not is_dup) and (s["n"] >= 80)  # 80 chars mínimo
+            if not is_dup:
+                seen[key] = not keep
 
             if keep:
-                kept += 1
-                scores.append(score)
-                per_doc_kept[obj["source_path"]] += 1
+                doc = docs.setdefault(obj["source_path"], len(docs))
+                candidates.append((key, mask, score, doc))
+                if len(candidates) >= MASK_FLUSH:
+                    np.array(candidates, dtype=CAND_DTYPE).tofile(fcand)
+                    candidates.clear()
 
                 out_obj = {
                     "source_path": obj["source_path"],
@@ -150,17 +242,114 @@ def main():
                     "quality_score": round(score, 4),
                     "text": text
                 }
-                fout.write(json.dumps(out_obj, ensure_ascii=False) + "\n")
+                fout.write(orjson.dumps(out_obj) + b"\n")
             else:
                 dropped += 1
                 if is_dup:
-                    drop_reasons["duplicate"] += 1
+                    mask |= DUPLICATE
                 if s["n"] < 80:
-                    drop_reasons["too_short"] += 1
-                for r in reasons:
-                    drop_reasons[r] += 1
-                if score < THRESH:
-                    drop_reasons["below_threshold"] += 1
+                    mask |= TOO_SHORT
+                if score < thresh:
+                    mask |= BELOW_THRESHOLD
+                masks.append(mask)
+
+            if len(masks) >= MASK_FLUSH:
+                reason_bits += count_reason_bits(masks)
+                masks.clear()
+
+        if candidates:
+            np.array(candidates, dtype=CAND_DTYPE).tofile(fcand)
+
+    if masks:
+        reason_bits += count_reason_bits(masks)
+
+    # dedup keys como arrays (8+1 bytes por key) en vez de un dict de ints
+    return {
+        "tmp_path": tmp_path,
+        "cand_path": cand_path,
+        "dropped": dropped,
+        "reason_bits": reason_bits,
+        "docs": list(docs),
+        "seen_keys": np.fromiter(seen.keys(), dtype=np.uint64, count=len(seen)),
+        "seen_dropped": np.fromiter(seen.values(), dtype=bool, count=len(seen)),
+    }
+
+def main():
+    in_path = Path("Francisco/docling_test3/chunks.jsonl")
+    out_path = Path("Francisco/docling_test4/chunks_filtered.jsonl")
+    report_path = Path("Francisco/docling_test4/filter_report.json")
+
+    # umbral por defecto (ajustable): 0.55 suele botar tablas/listados sin matar prosa
+    THRESH = 0.55
+    WORKERS = os.cpu_count() or 1
+
+    shards = shard_bounds(in_path, WORKERS)
+    jobs = [
+        (in_path, a, b, out_path.with_name(f"{out_path.name}.part{k}"), THRESH)
+        for k, (a, b) in enumerate(shards)
+    ]
+    # merge en orden de shard: dedup global + concatenación de los tmp
+    seen_keys = set()
+    kept = 0
+    dropped = 0
+    reason_bits = np.zeros(16, dtype=np.int64)
+    masks = []
+    # resumen de scores online (memoria constante) + docs con algún chunk kept
+    score_min = score_max = None
+    score_sum = 0.0
+    kept_docs = set()
+    dup_bit = DUPLICATE.bit_length() - 1
+
+    def merge(res: dict) -> None:
+        nonlocal kept, dropped, reason_bits, score_sum, score_min, score_max
+        dropped += res["dropped"]
+        reason_bits += res["reason_bits"]
+        docs = res["docs"]
+
+        with res["tmp_path"].open("rb") as ftmp:
+            for (key, mask, score, doc), line in zip(iter_candidates(res["cand_path"]), ftmp):
+                if key in seen_keys:  # duplicado de un shard anterior
+                    dropped += 1
+                    masks.append(mask | DUPLICATE)
+                    if len(masks) >= MASK_FLUSH:
+                        reason_bits += count_reason_bits(masks)
+                        masks.clear()
+                    continue
+                kept += 1
+                score_sum += score
+                score_min = score if score_min is None else min(score_min, score)
+                score_max = score if score_max is None else max(score_max, score)
+                kept_docs.add(docs[doc])
+                fout.write(line)
+        res["tmp_path"].unlink()
+        res["cand_path"].unlink()
+
+        for key, was_dropped in zip(res["seen_keys"].tolist(), res["seen_dropped"].tolist()):
+            if key not in seen_keys:
+                seen_keys.add(key)
+            elif was_dropped:
+                reason_bits[dup_bit] += 1
+
+    with out_path.open("wb") as fout:
+        if len(jobs) > 1:
+            # forkserver: workers livianos, sin heredar el estado del proceso padre;
+            # resultados consumidos shard a shard, en orden
+            with ProcessPoolExecutor(max_workers=len(jobs), mp_context=mp.get_context("forkserver")) as ex:
+                futures = [ex.submit(filter_shard, *job) for job in jobs]
+                for k in range(len(futures)):
+                    merge(futures[k].result())
+                    futures[k] = None
+        else:
+            for job in jobs:
+                merge(filter_shard(*job))
+
+    if masks:
+        reason_bits += count_reason_bits(masks)
+    drop_reasons = Counter({
+        name: int(reason_bits[bit.bit_length() - 1])
+        for bit, name in REASON_NAMES.items()
+        if reason_bits[bit.bit_length() - 1]
+    })
 
     # reporte
     report = {
@@ -169,14 +358,14 @@ def main():
         "threshold": THRESH,
         "kept": kept,
         "dropped": dropped,
-        "kept_unique_docs": len(per_doc_kept),
+        "kept_unique_docs": len(kept_docs),
         "docs_with_zero_kept_chunks": None,  # lo calculamos luego si quieres
         "drop_reasons_top": drop_reasons.most_common(15),
         "score_summary": {
-            "count": len(scores),
-            "min": min(scores) if scores else None,
-            "max": max(scores) if scores else None,
-            "avg": (sum(scores) / len(scores)) if scores else None,
+            "count": kept,
+            "min": score_min,
+            "max": score_max,
+            "avg": (score_sum / kept) if kept else None,
         }
     }
 
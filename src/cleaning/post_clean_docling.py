@@ -6,74 +6,51 @@ DOC_IN_ROOT = Path("/home/fteran/Francisco/docling test")
 DOC_OUT_ROOT = Path("/home/fteran/Francisco/docling_test2")
 DOC_OUT_ROOT.mkdir(parents=True, exist_ok=True)
 
-# quitar comentarios docling
-HTML_COMMENT_RE = re.compile(r"<!--.*?-->", re.DOTALL)
-
-# convertir &lt;math&gt; a <math> y eliminar tags <math>
-MATH_TAG_RE = re.compile(r"</?math>", re.IGNORECASE)
-
-# (opcional) otros tags que podrían colarse
-GENERIC_TAG_RE = re.compile(r"</?(sup|sub|span|b|i|u|em|strong)>", re.IGNORECASE)
+# tags/comentarios inline en una sola alternación:
+# comentarios docling (<!-- image -->), <math> (se conserva el contenido)
+# y otros tags simples que podrían colarse
+FUSED_STRIP_RE = re.compile(
+    r"<!--.*?-->|</?math>|</?(?:sup|sub|span|b|i|u|em|strong)>",
+    re.IGNORECASE | re.DOTALL,
+)
 
-# remover web y dirección en internet
-WEB_LINE_RE = re.compile(
-    r"^\s*(DIRECCIÓN EN INTERNET:|DIRECCION EN INTERNET:)?\s*www\.eluniverso\.com\s*$",
-    re.IGNORECASE,
+# patrones por línea, en una sola pasada (re.M):
+# 1) línea web / dirección en internet (se elimina con su salto)
+# 2) bloque índice: desde "## INDICE" hasta antes de la siguiente sección fuerte
+#    (o hasta el final si no aparece)
+# 3) espacios al final de línea
+HS = r"[^\S\n]"  # espacio horizontal (no cruza líneas)
+IDX_END = (
+    rf"{HS}*##{HS}*(?:Ayuda a|EDC|Se incrementó|Bancomex|Mas provisiones|Recaudaciones|out clausuro)\b"
+)
+LINE_STRIP_RE = re.compile(
+    rf"^{HS}*(?:DIRECCIÓN EN INTERNET:|DIRECCION EN INTERNET:)?{HS}*www\.eluniverso\.com{HS}*(?:\n|\Z)"
+    rf"|^{HS}*##{HS}*INDICE{HS}*$(?:\n(?!{IDX_END}).*)*\n?"
+    rf"|{HS}+$",
+    re.IGNORECASE | re.MULTILINE,
 )
 
-# detectar bloque índice (lo removemos completo)
-IDX_START_RE = re.compile(r"^\s*##\s*INDICE\s*$", re.IGNORECASE)
+MULTI_NL_RE = re.compile(r"\n{4,}")
 
-# stop cuando termina el índice (cuando vuelve a otra sección fuerte)
-IDX_END_RE = re.compile(
-    r"^\s*##\s*(Ayuda a|EDC|Se incrementó|Bancomex|Mas provisiones|Recaudaciones|out clausuro)\b",
-    re.IGNORECASE,
-)
+# otros saltos de línea que str.splitlines() reconoce (form feed = salto de página, etc.) -> "\n",
+# así los patrones por línea (que solo miran "\n") cortan igual que antes
+LINE_SEP_TBL = str.maketrans({c: "\n" for c in "\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"})
 
 def soft_clean_raw(md: str) -> str:
     md = md.replace("\r\n", "\n").replace("\r", "\n")
 
     # 0) decode HTML entities (&lt; &gt; &amp; etc.)
     md = html.unescape(md)
+    md = md.translate(LINE_SEP_TBL)
 
-    # 0.1) elimina tags <math>...</math> manteniendo contenido
-    md = MATH_TAG_RE.sub("", md)
-
-    # (opcional) limpia algunos tags simples si aparecen
-    md = GENERIC_TAG_RE.sub("", md)
-
-    # 1) quitar <!-- image -->
-    md = HTML_COMMENT_RE.sub("", md)
-
-    lines = md.splitlines()
-    out = []
-
-    skipping_index = False
-
-    for ln in lines:
-        t = ln.rstrip()
-
-        # 2) quitar línea web
-        if WEB_LINE_RE.match(t.strip()):
-            continue
-
-        # 3) remover bloque índice completo
-        if IDX_START_RE.match(t.strip()):
-            skipping_index = True
-            continue
-
-        if skipping_index:
-            # termina cuando aparece una sección grande de nuevo
-            if IDX_END_RE.match(t.strip()):
-                skipping_index = False
-                out.append(t)  # incluir la línea que reanuda contenido
-            continue
+    # 0.1) quitar <!-- image -->, tags <math> (manteniendo contenido) y tags simples
+    md = FUSED_STRIP_RE.sub("", md)
 
-        out.append(t)
+    # 1) quitar línea web, bloque índice completo y espacios finales
+    text = LINE_STRIP_RE.sub("", md)
 
     # limpiar saltos múltiples excesivos
-    text = "\n".join(out)
-    text = re.sub(r"\n{4,}", "\n\n\n", text)
+    text = MULTI_NL_RE.sub("\n\n\n", text)
 
     return text.strip() + "\n"
 
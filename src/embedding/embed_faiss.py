@@ -1,27 +1,199 @@
 from __future__ import annotations
-import argparse, json, time
+import argparse, json, time, unicodedata
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
 import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import faiss
 
+TRAIN_SAMPLE = 100_000  # máx. vectores para entrenar índices IVF/PQ
+HNSW_M = 32               # vecinos por nodo del grafo HNSW
+HNSW_EF_CONSTRUCTION = 100
+PARQUET_ROWS = 50_000     # filas por row group de meta.parquet
+
+ACCENT_TBL = str.maketrans("áéíóúüñàèìòùâêîôûäëïöç", "aeiouunaeiouaeiouaeioc")
+
+def norm(s: str) -> str:
+    # misma normalización que query.py (minúsculas, sin acentos) para el rerank por keywords
+    s = s.lower().translate(ACCENT_TBL)
+    if s.isascii():
+        return s
+    s = unicodedata.normalize("NFKD", s)
+    return "".join(ch for ch in s if not unicodedata.combining(ch))
+
+# keep-alive + pool de conexiones: reutilizado por todos los batches (y threads)
+SESSION = requests.Session()
+for _prefix in ("http://", "https://"):
+    SESSION.mount(_prefix, HTTPAdapter(pool_connections=4, pool_maxsize=40))
+
 def ollama_embed(texts, model: str, host: str):
-    # Ollama embeddings endpoint
+    # /api/embed acepta el batch completo en "input": un round trip por batch
+    r = SESSION.post(host.rstrip("/") + "/api/embed",
+                     json={"model": model, "input": list(texts)}, timeout=300)
+    if r.status_code != 404:
+        r.raise_for_status()
+        data = r.json()
+        if "embeddings" in data:
+            return np.asarray(data["embeddings"], dtype="float32")
+
+    # fallback (Ollama sin /api/embed): endpoint viejo, un request por texto
     url = host.rstrip("/") + "/api/embeddings"
     vecs = []
     for t in texts:
-        r = requests.post(url, json={"model": model, "prompt": t}, timeout=120)
+        r = SESSION.post(url, json={"model": model, "prompt": t}, timeout=120)
         r.raise_for_status()
         v = r.json()["embedding"]
         vecs.append(v)
     return np.array(vecs, dtype="float32")
 
+def train_index(index, vecs: np.ndarray, key: str) -> None:
+    n = len(vecs)
+    if n > TRAIN_SAMPLE:
+        rng = np.random.default_rng(0)
+        train = vecs[np.sort(rng.choice(n, TRAIN_SAMPLE, replace=False))]
+    else:
+        train = vecs
+    print(f"entrenando {key} con {len(train)} vectores")
+    index.train(train)
+
+def build_index(vecs: np.ndarray, index_type: str, metric: int, nprobe: int = 16):
+    """Devuelve (índice vacío/entrenado, key estilo index_factory, index_type construido realmente)."""
+    n, d = vecs.shape
+    if index_type == "ivfpq" and n < 256:
+        print("pocos vectores para entrenar PQ (<256), uso Flat")
+        index_type = "flat"
+
+    if index_type == "ivfpq":
+        # OPQ + IVF + PQ: códigos de 32 bytes por vector (8-16x menos memoria que Flat)
+        # y búsqueda solo sobre nprobe listas invertidas. Requiere d múltiplo de 32.
+        nlist = max(1, int(np.sqrt(n)))
+        key = f"OPQ32_{d},IVF{nlist},PQ32"  # _{d} explícito (= default): formato que reconoce autofaiss
+        index = faiss.index_factory(d, key, metric)
+        train_index(index, vecs, key)
+        faiss.extract_index_ivf(index).nprobe = nprobe
+        return index, key, index_type
+
+    if index_type == "sq8":
+        # cuantización escalar a 1 byte/dim: 4x menos ancho de banda que Flat en cada scan
+        index = faiss.index_factory(d, "SQ8", metric)
+        train_index(index, vecs, "SQ8")
+        return index, "SQ8", index_type
+
+    if index_type == "fp16":
+        # Flat con almacenamiento fp16: la mitad de bytes por scan, pérdida de recall despreciable
+        return faiss.IndexScalarQuantizer(d, faiss.ScalarQuantizer.QT_fp16, metric), "SQfp16", index_type
+
+    if index_type == "hnsw":
+        # grafo HNSW: búsqueda ~O(log n), sin entrenamiento
+        index = faiss.IndexHNSWFlat(d, HNSW_M, metric)
+        index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+        return index, f"HNSW{HNSW_M}", index_type
+
+    return faiss.IndexFlat(d, metric), "Flat", "flat"
+
+def search_params(index_type: str, ef_search: int, nprobe: int) -> str:
+    # formato de faiss.ParameterSpace; query.py lo aplica al cargar el índice
+    if index_type == "hnsw":
+        return f"efSearch={ef_search}"
+    if index_type == "ivfpq":
+        return f"nprobe={nprobe}"
+    return ""
+
+def try_tune_index(index, key: str, max_ms: float, k: int):
+    # autofaiss (opcional): búsqueda greedy de efSearch/nprobe bajo un presupuesto de ms/query
+    try:
+        from autofaiss import tune_index  # type: ignore
+    except ImportError:
+        print("autofaiss no instalado (pip install autofaiss): uso --ef-search/--nprobe")
+        return None
+    return tune_index(index, key, save_on_disk=False,
+                      min_nearest_neighbors_to_retrieve=k, max_index_query_time_ms=max_ms)
+
+def current_search_params(index) -> str:
+    # lee efSearch/nprobe del índice (ej. después de tune_index) en formato ParameterSpace
+    try:
+        return f"nprobe={faiss.extract_index_ivf(index).nprobe}"
+    except RuntimeError:
+        pass
+    index = faiss.downcast_index(index)
+    if hasattr(index, "hnsw"):
+        return f"efSearch={index.hnsw.efSearch}"
+    return ""
+
+def build_binary_index(vecs: np.ndarray):
+    # 1 bit por dimensión (signo): 32x menos memoria, búsqueda por Hamming
+    d = vecs.shape[1]
+    if d % 8:
+        raise ValueError(f"índice binario requiere dim múltiplo de 8 (dim={d})")
+    bindex = faiss.IndexBinaryFlat(d)
+    bindex.add(np.packbits(vecs > 0, axis=1))
+    return bindex
+
+def count_jsonl(path: Path) -> int:
+    # líneas no vacías, sin parsear: da N para crear vecs.npy antes de embeddar
+    with path.open("rb") as f:
+        return sum(1 for line in f if line.strip())
+
+def batched(it, n: int):
+    it = iter(it)
+    while True:
+        chunk = list(islice(it, n))
+        if not chunk:
+            return
+        yield chunk
+
+def save_fp16(vecs: np.ndarray, path: Path, block: int = 65536) -> None:
+    # reescribe vecs.npy como float16 por bloques (sin copia completa en RAM)
+    tmp = path.with_name(path.stem + ".f16.tmp.npy")
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype="float16", shape=vecs.shape)
+    for i in range(0, len(vecs), block):
+        out[i:i+block] = vecs[i:i+block]
+    out.flush()
+    del out
+    tmp.replace(path)
+
+class ParquetMeta:
+    """meta.parquet en paralelo a meta.jsonl (pyarrow opcional): zstd + source_path con diccionario."""
+
+    def __init__(self, path: Path):
+        import pyarrow as pa  # type: ignore
+        import pyarrow.parquet as pq  # type: ignore
+        self.pa = pa
+        self.schema = pa.schema([
+            ("id", pa.string()),
+            ("source_path", pa.string()),
+            ("chunk_index", pa.int32()),
+            ("quality_score", pa.float64()),
+            ("text", pa.string()),
+            ("text_norm", pa.string()),
+        ])
+        self.writer = pq.ParquetWriter(path, self.schema, compression="zstd", use_dictionary=["source_path"])
+        self.buf = []
+
+    def add(self, rec: dict) -> None:
+        self.buf.append(rec)
+        if len(self.buf) >= PARQUET_ROWS:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.buf:
+            self.writer.write_table(self.pa.Table.from_pylist(self.buf, schema=self.schema))
+            self.buf = []
+
+    def close(self) -> None:
+        self.flush()
+        self.writer.close()
+
 def iter_jsonl(path: Path):
-    with path.open("r", encoding="utf-8") as f:
+    with path.open("rb") as f:
         for line in f:
             line = line.strip()
             if line:
-                yield json.loads(line)
+                yield orjson.loads(line)
 
 def main():
     ap = argparse.ArgumentParser()
@@ -29,8 +201,23 @@ def main():
     ap.add_argument("--outdir", required=True, help="Directorio salida índice")
     ap.add_argument("--model", default="nomic-embed-text", help="Modelo de embeddings en Ollama")
     ap.add_argument("--host", default="http://localhost:11434", help="Host Ollama")
-    ap.add_argument("--batch", type=int, default=16, help="Batch size (secuencia, no paralelo)")
+    ap.add_argument("--batch", type=int, default=64, help="Textos por request a /api/embed")
+    ap.add_argument("--workers", type=int, default=4, help="Requests concurrentes a Ollama")
     ap.add_argument("--normalize", action="store_true", help="Normalizar (cosine vía inner product)")
+    ap.add_argument("--index-type", choices=["flat", "fp16", "sq8", "hnsw", "ivfpq"], default="flat",
+                    help="flat (exacto), fp16 (flat en float16; vecs.npy también), sq8 (flat con 1 byte/dim), "
+                         "hnsw (HNSW32, 10k-1M vectores) o "
+                         "ivfpq (OPQ32,IVF{sqrt(N)},PQ32: menos memoria, >1M vectores)")
+    ap.add_argument("--ef-search", type=int, default=64, help="Candidatos explorados por query (solo hnsw)")
+    ap.add_argument("--nprobe", type=int, default=16, help="Listas IVF a visitar por query (solo ivfpq)")
+    ap.add_argument("--tune-ms", type=float, default=None,
+                    help="Autoajustar efSearch/nprobe con autofaiss para este presupuesto (ms/query); solo hnsw/ivfpq")
+    ap.add_argument("--tune-k", type=int, default=400,
+                    help="Vecinos mínimos a recuperar al autoajustar (query.py usa oversample 400-700)")
+    ap.add_argument("--parquet", action="store_true",
+                    help="Guardar además meta.parquet (requiere pyarrow); query.py lo prefiere a meta.jsonl")
+    ap.add_argument("--binary", action="store_true",
+                    help="Guardar además índice binario (Hamming) para pre-rank; el rerank float usa vecs.npy")
     args = ap.parse_args()
 
     inp = Path(args.inp)
@@ -38,24 +225,40 @@ def main():
     outdir.mkdir(parents=True, exist_ok=True)
 
     meta_path = outdir / "meta.jsonl"
+    parquet_path = outdir / "meta.parquet"
     index_path = outdir / "faiss.index"
+    params_path = outdir / "params.json"
+    bindex_path = outdir / "faiss.bindex"
+    vecs_path = outdir / "vecs.npy"
 
-    # leer todo (puedes hacerlo streaming, pero para 30k chunks está ok)
-    rows = list(iter_jsonl(inp))
-    print("chunks:", len(rows))
+    # streaming: solo hay en memoria los batches en vuelo, no todo el JSONL
+    n_rows = count_jsonl(inp)
+    print("chunks:", n_rows)
 
-    # embeddar
-    all_vecs = []
-    with meta_path.open("w", encoding="utf-8") as mf:
-        for i in range(0, len(rows), args.batch):
-            batch = rows[i:i+args.batch]
-            texts = [x["text"] for x in batch]
-            vecs = ollama_embed(texts, model=args.model, host=args.host)
+    # embeddar: batches en paralelo (I/O contra Ollama), resultados consumidos en orden
+    vecs_out = None  # memmap (N, d) en vecs.npy; se crea al conocer d con el primer batch
+    done = 0
+    pqm = None
+    if args.parquet:
+        try:
+            pqm = ParquetMeta(parquet_path)
+        except ImportError:
+            raise SystemExit("--parquet requiere pyarrow (pip install pyarrow)")
+    elif parquet_path.exists():
+        parquet_path.unlink()  # no dejar uno viejo que query.py leería en vez del meta.jsonl nuevo
+    with meta_path.open("wb") as mf, ThreadPoolExecutor(max_workers=args.workers) as ex:
+        pending = deque()
 
-            if args.normalize:
-                faiss.normalize_L2(vecs)
+        def consume():
+            nonlocal vecs_out, done
+            batch, fut = pending.popleft()
+            vecs = fut.result()
 
-            all_vecs.append(vecs)
+            if vecs_out is None:
+                vecs_out = np.lib.format.open_memmap(
+                    vecs_path, mode="w+", dtype="float32", shape=(n_rows, vecs.shape[1])
+                )
+            vecs_out[done:done+len(batch)] = vecs
 
             # guardar metadata en el mismo orden que los vectores
             for x in batch:
@@ -65,27 +268,70 @@ def main():
                     "chunk_index": x["chunk_index"],
                     "quality_score": x.get("quality_score", None),
                     "text": x["text"],
+                    "text_norm": norm(x["text"]),
                 }
-                mf.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                mf.write(orjson.dumps(rec) + b"\n")
+                if pqm is not None:
+                    pqm.add(rec)
 
-            if (i // args.batch) % 20 == 0:
-                print(f"embeddings: {min(i+args.batch, len(rows))}/{len(rows)}")
+            done += len(batch)
+            if (done // args.batch) % 20 == 1:
+                print(f"embeddings: {done}/{n_rows}")
                 time.sleep(0.01)
 
-    vecs = np.vstack(all_vecs).astype("float32")
+        for batch in batched(iter_jsonl(inp), args.batch):
+            pending.append((batch, ex.submit(ollama_embed, [x["text"] for x in batch],
+                                             model=args.model, host=args.host)))
+            # ventana acotada de requests en vuelo
+            if len(pending) >= 2 * args.workers:
+                consume()
+        while pending:
+            consume()
+
+    if pqm is not None:
+        pqm.close()
+
+    if vecs_out is None:
+        raise SystemExit(f"sin chunks en {inp}")
+    if args.normalize:
+        # una sola pasada sobre (N, d) contiguo en vez de una llamada por batch
+        faiss.normalize_L2(vecs_out)
+    vecs_out.flush()
+    vecs = vecs_out
     d = vecs.shape[1]
     print("dim:", d)
 
     # índice: si normalizas, usa IP para cosine; si no, usa L2
-    if args.normalize:
-        index = faiss.IndexFlatIP(d)
-    else:
-        index = faiss.IndexFlatL2(d)
+    metric = faiss.METRIC_INNER_PRODUCT if args.normalize else faiss.METRIC_L2
+    # index_type puede cambiar (ivfpq con <256 vectores -> flat): params según lo construido
+    index, key, index_type = build_index(vecs, args.index_type, metric, nprobe=args.nprobe)
 
     index.add(vecs)
+    params = search_params(index_type, args.ef_search, args.nprobe)
+    if params:
+        faiss.ParameterSpace().set_index_parameters(index, params)
+    if args.tune_ms is not None and params:
+        tuned = try_tune_index(index, key, args.tune_ms, args.tune_k)
+        if tuned is not None:
+            index = tuned
+            params = current_search_params(index)
     faiss.write_index(index, str(index_path))
-    print("OK índice:", index_path)
+    params_path.write_text(
+        json.dumps({"index_type": index_type, "search_params": params}, indent=2), encoding="utf-8"
+    )
+    print("OK índice:", index_path, index_type, params)
+
+    if args.binary:
+        faiss.write_index_binary(build_binary_index(vecs), str(bindex_path))
+        print("OK índice binario:", bindex_path)
+    if args.index_type == "fp16":
+        # el rerank de app.py castea a float32 los candidatos
+        del vecs, vecs_out
+        save_fp16(np.load(vecs_path, mmap_mode="r"), vecs_path)
     print("OK meta:", meta_path)
+    if pqm is not None:
+        print("OK meta parquet:", parquet_path)
+    print("OK vecs:", vecs_path)
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,12 @@
+from __future__ import annotations
+
+import multiprocessing as mp
 import os
-import json
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
+import orjson
+
 from docling.document_converter import DocumentConverter, PdfFormatOption
 from docling.datamodel.base_models import InputFormat
 from docling.datamodel.pipeline_options import PdfPipelineOptions
@@ -18,28 +23,27 @@ IN_ROOT = Path(
 
 OUT_ROOT = Path("/home/fteran/Francisco/docling test")
 
+# docling.json (layout completo); False si downstream solo usa raw.md
+EXPORT_JSON = True
 
-# ---------------------------
-# Main
-# ---------------------------
-def main():
-    OUT_ROOT.mkdir(parents=True, exist_ok=True)
+# GPUs a repartir entre workers (worker k -> GPU_IDS[k % len]); vacío = no tocar CUDA_VISIBLE_DEVICES
+GPU_IDS: list[int] = []
 
-    # Buscar SOLO JPG originales
-    images = sorted(IN_ROOT.glob("*.jpg")) + sorted(IN_ROOT.glob("*.JPG"))
-    images = sorted(images)
+# OCR en CPU (sin GPU): recién ahí conviene repartir por núcleos
+OCR_ON_CPU = False
 
-    print(f"IN_ROOT: {IN_ROOT}")
-    print(f"OUT_ROOT: {OUT_ROOT}")
-    print(f"Found {len(images)} images")
+# procesos en paralelo (cada uno carga su propio converter/modelos): uno por GPU listada,
+# así no se apilan varios modelos en la misma GPU; por defecto 1 = secuencial como antes
+WORKERS = max(1, (os.cpu_count() or 2) // 2) if OCR_ON_CPU else max(1, len(GPU_IDS))
 
-    if len(images) == 0:
-        print("\n⚠️ No encontré JPG. Revisa el path:")
-        print(IN_ROOT)
-        return
 
-    print("First 5:", [p.name for p in images[:5]])
+# ---------------------------
+# Worker
+# ---------------------------
+_converter = None
+
 
+def build_converter() -> DocumentConverter:
     # Docling usando SuryaOCR plugin
     pipeline_options = PdfPipelineOptions(
         do_ocr=True,
@@ -48,40 +52,114 @@ def main():
         ocr_options=SuryaOcrOptions(lang=["es"]),
     )
 
-    converter = DocumentConverter(
+    return DocumentConverter(
         format_options={
             InputFormat.IMAGE: PdfFormatOption(pipeline_options=pipeline_options),
         }
     )
 
-    for i, img in enumerate(images, 1):
-        name = img.stem  # 00001
-        out_dir = OUT_ROOT / name
-        out_dir.mkdir(parents=True, exist_ok=True)
 
-        print(f"\n[{i}/{len(images)}] [IMG] {img.name}")
+def _init_worker(rank_counter=None) -> None:
+    # un converter por proceso, reutilizado para todas sus imágenes
+    global _converter
+    if rank_counter is not None and GPU_IDS:
+        with rank_counter.get_lock():
+            rank = rank_counter.value
+            rank_counter.value += 1
+        # antes de cargar los modelos: CUDA se inicializa recién en el primer uso
+        os.environ["CUDA_VISIBLE_DEVICES"] = str(GPU_IDS[rank % len(GPU_IDS)])
+    _converter = build_converter()
+
 
-        try:
-            # 1) Docling -> Markdown
-            result = converter.convert(str(img))
-            raw_md = result.document.export_to_markdown()
-            (out_dir / "raw.md").write_text(raw_md, encoding="utf-8")
+def _process(img: Path) -> str | None:
+    """OCR de una imagen -> OUT_ROOT/<stem>/raw.md + docling.json. Devuelve el error o None."""
+    out_dir = OUT_ROOT / img.stem  # 00001
+    out_dir.mkdir(parents=True, exist_ok=True)
 
-            # 2) Docling -> JSON layout
+    try:
+        # 1) Docling -> Markdown
+        result = _converter.convert(str(img))
+        raw_md = result.document.export_to_markdown()
+        (out_dir / "raw.md").write_text(raw_md, encoding="utf-8")
+
+        # 2) Docling -> JSON layout (compacto: sin indent)
+        if EXPORT_JSON:
             try:
                 doc_dict = result.document.export_to_dict()
-                (out_dir / "docling.json").write_text(
-                    json.dumps(doc_dict, ensure_ascii=False, indent=2),
-                    encoding="utf-8",
+                (out_dir / "docling.json").write_bytes(
+                    orjson.dumps(doc_dict, option=orjson.OPT_NON_STR_KEYS)
                 )
             except Exception as e:
                 (out_dir / "docling_json_error.txt").write_text(
                     str(e), encoding="utf-8"
                 )
 
-        except Exception as e:
-            (out_dir / "ERROR.txt").write_text(str(e), encoding="utf-8")
-            print(f"ERROR con {img.name}: {e}")
+    except Exception as e:
+        (out_dir / "ERROR.txt").write_text(str(e), encoding="utf-8")
+        return str(e)
+
+    return None
+
+
+def is_done(img: Path) -> bool:
+    # re-runs: saltar imágenes ya procesadas (raw.md y, si se exporta, docling.json)
+    out_dir = OUT_ROOT / img.stem
+    return (out_dir / "raw.md").exists() and (not EXPORT_JSON or (out_dir / "docling.json").exists())
+
+
+def _print_progress(images, results) -> None:
+    # resultados en el mismo orden que images
+    for i, (img, err) in enumerate(zip(images, results), 1):
+        print(f"\n[{i}/{len(images)}] [IMG] {img.name}")
+        if err is not None:
+            print(f"ERROR con {img.name}: {err}")
+
+
+# ---------------------------
+# Main
+# ---------------------------
+def main():
+    OUT_ROOT.mkdir(parents=True, exist_ok=True)
+
+    # Buscar SOLO JPG originales
+    images = sorted(IN_ROOT.glob("*.jpg")) + sorted(IN_ROOT.glob("*.JPG"))
+    images = sorted(images)
+
+    print(f"IN_ROOT: {IN_ROOT}")
+    print(f"OUT_ROOT: {OUT_ROOT}")
+    print(f"Found {len(images)} images")
+
+    if len(images) == 0:
+        print("\n⚠️ No encontré JPG. Revisa el path:")
+        print(IN_ROOT)
+        return
+
+    print("First 5:", [p.name for p in images[:5]])
+
+    todo = [p for p in images if not is_done(p)]
+    if len(todo) < len(images):
+        print(f"Ya procesadas: {len(images) - len(todo)} (se saltan)")
+    images = todo
+    if not images:
+        print("\nDONE (nada pendiente):", OUT_ROOT)
+        return
+
+    workers = min(WORKERS, len(images))
+    print(f"Workers: {workers}" + (f" | GPUs: {GPU_IDS}" if GPU_IDS else ""))
+
+    if workers <= 1:
+        _init_worker()
+        _print_progress(images, map(_process, images))
+    else:
+        # spawn: CUDA no sobrevive a fork; cada worker inicializa sus propios modelos
+        ctx = mp.get_context("spawn")
+        with ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=ctx,
+            initializer=_init_worker,
+            initargs=(ctx.Value("i", 0),),
+        ) as ex:
+            _print_progress(images, ex.map(_process, images, chunksize=1))
 
     print("\nDONE Saved to:", OUT_ROOT)
 
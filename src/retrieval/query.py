@@ -1,7 +1,13 @@
+import argparse
 import json
+import mmap
+import os
+from functools import lru_cache
 from pathlib import Path
 import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 import faiss
 import re
 import unicodedata
@@ -9,16 +15,27 @@ import unicodedata
 # -----------------------------
 # Text normalization
 # -----------------------------
+# letras acentuadas típicas del español -> ASCII vía str.translate (en C)
+ACCENT_TBL = str.maketrans("áéíóúüñàèìòùâêîôûäëïöç", "aeiouunaeiouaeiouaeioc")
+
 def norm(s: str) -> str:
-    s = s.lower()
+    s = s.lower().translate(ACCENT_TBL)
+    if s.isascii():
+        return s
+    # quedan otros caracteres no ASCII: camino lento NFKD
     s = unicodedata.normalize("NFKD", s)
     return "".join(ch for ch in s if not unicodedata.combining(ch))
 
 # -----------------------------
 # Embedding (Ollama)
 # -----------------------------
+# keep-alive + pool de conexiones: no abrir una conexión nueva por query
+SESSION = requests.Session()
+for _prefix in ("http://", "https://"):
+    SESSION.mount(_prefix, HTTPAdapter(pool_connections=4, pool_maxsize=40))
+
 def embed_one(q, model="nomic-embed-text", host="http://localhost:11434"):
-    r = requests.post(
+    r = SESSION.post(
         host.rstrip("/") + "/api/embeddings",
         json={"model": model, "prompt": q},
         timeout=120,
@@ -28,8 +45,84 @@ def embed_one(q, model="nomic-embed-text", host="http://localhost:11434"):
     faiss.normalize_L2(v)
     return v
 
-def load_meta(meta_path: Path):
-    return [json.loads(x) for x in meta_path.read_text(encoding="utf-8").splitlines() if x.strip()]
+def apply_search_params(index, index_dir: Path) -> None:
+    # efSearch / nprobe guardados por embed_faiss.py en params.json
+    p = index_dir / "params.json"
+    if not p.exists():
+        return
+    params = json.loads(p.read_text(encoding="utf-8")).get("search_params")
+    if params:
+        faiss.ParameterSpace().set_index_parameters(index, params)
+
+META_STR_FIELDS = ("id", "source_path", "quality_score", "text", "text_norm")
+
+def _obj_array(values: list) -> np.ndarray:
+    a = np.empty(len(values), dtype=object)
+    a[:] = values
+    return a
+
+def load_meta(meta_path: Path) -> dict:
+    """
+    meta.jsonl en columnas (SoA): {campo: array alineado con los ids de FAISS}.
+    Con I de index.search, meta["source_path"][I[0]] es un solo gather.
+    """
+    # orjson directo sobre las líneas del mmap (sin decodificar el archivo entero a str)
+    rows = []
+    with meta_path.open("rb") as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                rows = [orjson.loads(line) for line in iter(mm.readline, b"") if line.strip()]
+
+    meta = {k: _obj_array([m.get(k) for m in rows]) for k in META_STR_FIELDS}
+    meta["chunk_index"] = np.fromiter((m["chunk_index"] for m in rows), dtype=np.int32, count=len(rows))
+    # text_norm viene precalculado en meta.jsonl (embed_faiss.py); meta viejo -> norm() una vez al cargar
+    if rows and "text_norm" not in rows[0]:
+        meta["text_norm"] = _obj_array([norm(m["text"]) for m in rows])
+    return meta
+
+def load_meta_parquet(parquet_path: Path):
+    # meta.parquet (embed_faiss.py --parquet): columnas directo a numpy; None si no hay pyarrow
+    try:
+        import pyarrow.parquet as pq  # type: ignore
+    except ImportError:
+        return None
+    t = pq.read_table(parquet_path, read_dictionary=["source_path"])
+    meta = {k: t.column(k).to_numpy(zero_copy_only=False) for k in ("id", "source_path", "text", "text_norm")}
+    meta["quality_score"] = _obj_array(t.column("quality_score").to_pylist())  # null -> None, igual que jsonl
+    meta["chunk_index"] = t.column("chunk_index").to_numpy().astype(np.int32)
+    return meta
+
+def meta_row(meta: dict, i: int) -> dict:
+    # dict por chunk solo para los resultados finales
+    row = {k: meta[k][i] for k in META_STR_FIELDS}
+    row["chunk_index"] = int(meta["chunk_index"][i])
+    return row
+
+@lru_cache(maxsize=1)
+def gpu_resources():
+    # un solo StandardGpuResources por proceso; memoria temporal reservada de antemano
+    # para no asignar en cada search
+    res = faiss.StandardGpuResources()
+    res.setTempMemory(256 << 20)
+    return res
+
+@lru_cache(maxsize=4)
+def _load(index_dir: str, use_gpu: bool = False):
+    # índice + meta se leen una sola vez por directorio (HQ y ALL quedan en cache)
+    d = Path(index_dir)
+    index = faiss.read_index(str(d / "faiss.index"))
+    apply_search_params(index, d)  # nprobe se copia al clonar a GPU
+    if use_gpu and hasattr(faiss, "StandardGpuResources") and faiss.get_num_gpus() > 0:
+        try:
+            index = faiss.index_cpu_to_gpu(gpu_resources(), 0, index)
+        except RuntimeError as e:
+            print(f"[gpu] {d.name}: sin versión GPU para este índice, uso CPU ({e})")
+    meta = None
+    if (d / "meta.parquet").exists():
+        meta = load_meta_parquet(d / "meta.parquet")
+    if meta is None:
+        meta = load_meta(d / "meta.jsonl")
+    return index, meta
 
 # -----------------------------
 # Rerank helpers
@@ -60,42 +153,115 @@ def informative_qwords(query: str):
             seen.add(w)
     return out
 
-def keyword_hits_norm(text_norm: str, qwords) -> int:
-    if not qwords:
-        return 0
-    return sum(1 for w in qwords if w in text_norm)
-
-def rerank_score(base: float, text: str, qwords) -> tuple[float, int]:
-    tn = norm(text)
-    hits = keyword_hits_norm(tn, qwords)
-
-    score = base + 0.03 * hits
+def _compute_scores_np(base, hits, no_politic, official, need):
+    scores = base.astype(np.float64) + 0.03 * hits
 
     # Si el query incluye "politica", exigir señal política ("politic" cubre politica/politico/politicos)
-    if "politica" in qwords and "politic" not in tn:
-        score -= 0.35
+    scores[no_politic] -= 0.35
 
     # Si hay 2+ keywords informativas, penaliza fuerte si solo pega 0-1
-    if len(qwords) >= 2 and hits < 2:
-        score -= 0.20
+    if need >= 2:
+        scores[hits < 2] -= 0.20
 
     # Sin hits -> baja extra
-    if qwords and hits == 0:
-        score -= 0.10
+    if need > 0:
+        scores[hits == 0] -= 0.10
 
     # Oficios/plantillas -> baja suave
-    if OFFICIAL_HINT.search(tn):
-        score -= 0.05
+    scores[official] -= 0.05
+    return scores
 
-    return score, hits
+def _compute_scores_kernel(base, hits, no_politic, official, need):
+    # mismas reglas que _compute_scores_np, en un solo loop (compilado con numba)
+    n = base.shape[0]
+    scores = np.empty(n, dtype=np.float64)
+    for i in range(n):
+        s = np.float64(base[i]) + 0.03 * hits[i]
+        if no_politic[i]:
+            s -= 0.35
+        if need >= 2 and hits[i] < 2:
+            s -= 0.20
+        if need > 0 and hits[i] == 0:
+            s -= 0.10
+        if official[i]:
+            s -= 0.05
+        scores[i] = s
+    return scores
+
+# import + carga/compilación de numba cuestan ~0.3 s y ahorran ~30 ns por hit: solo compensa
+# con millones de hits por llamada (oversample normal: 400-700 -> numpy)
+NUMBA_MIN_HITS = 1_000_000
+
+@lru_cache(maxsize=1)
+def _numba_kernel():
+    try:
+        from numba import njit  # opcional: kernel nativo, import perezoso
+    except ImportError:
+        return None
+    return njit(cache=True)(_compute_scores_kernel)
+
+def compute_scores(base, hits, no_politic, official, need):
+    if len(base) >= NUMBA_MIN_HITS:
+        kernel = _numba_kernel()
+        if kernel is not None:
+            return kernel(base, hits, no_politic, official, need)
+    return _compute_scores_np(base, hits, no_politic, official, need)
+
+def build_kw_automaton(words):
+    # Aho-Corasick (pyahocorasick opcional): una pasada por texto, independiente de |words|
+    if not words:
+        return None
+    try:
+        import ahocorasick  # type: ignore
+    except Exception:
+        return None
+    # palabra -> todas sus columnas (una palabra puede repetirse, ej. qword "politic" + columna extra)
+    cols = {}
+    for k, w in enumerate(words):
+        cols.setdefault(w, []).append(k)
+    A = ahocorasick.Automaton()
+    for w, ks in cols.items():
+        A.add_word(w, ks)
+    A.make_automaton()
+    return A
+
+def presence_matrix(tns: list, words) -> np.ndarray:
+    """P[i, k] = words[k] aparece en tns[i] (substring)."""
+    n = len(tns)
+    P = np.zeros((n, len(words)), dtype=np.uint8)
+    A = build_kw_automaton(words)
+    if A is None:
+        for k, w in enumerate(words):
+            P[:, k] = np.fromiter((w in tn for tn in tns), dtype=bool, count=n)
+        return P
+    for i, tn in enumerate(tns):
+        for _, ks in A.iter(tn):
+            P[i, ks] = 1
+    return P
+
+def rerank_scores(base: np.ndarray, tns: list, qwords) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Rerank vectorizado sobre todos los resultados de FAISS a la vez.
+    tns: textos normalizados (text_norm). Devuelve (scores float64, hits int).
+    """
+    n = len(tns)
+    K = len(qwords)
+    # Si el query incluye "politica", exigir señal política ("politic" cubre politica/politico/politicos);
+    # va como columna extra en la misma pasada
+    check_politic = "politica" in qwords
+    P = presence_matrix(tns, list(qwords) + ["politic"] if check_politic else list(qwords))
+    hits = P[:, :K].sum(axis=1, dtype=np.int64)
+    no_politic = P[:, K] == 0 if check_politic else np.zeros(n, dtype=bool)
+    official = np.fromiter((OFFICIAL_HINT.search(tn) is not None for tn in tns), dtype=bool, count=n)
+
+    scores = compute_scores(np.ascontiguousarray(base, dtype=np.float32), hits, no_politic, official, K)
+    return scores, hits
 
 # -----------------------------
 # Retrieval: top docs + top chunks (HITS-AWARE DOC SCORE)
 # -----------------------------
-def search_docs_top_chunks(index_dir, query, k_docs=5, chunks_per_doc=2, oversample=400):
-    index_dir = Path(index_dir)
-    index = faiss.read_index(str(index_dir / "faiss.index"))
-    meta  = load_meta(index_dir / "meta.jsonl")
+def search_docs_top_chunks(index_dir, query, k_docs=5, chunks_per_doc=2, oversample=400, use_gpu=False):
+    index, meta = _load(str(index_dir), use_gpu)
 
     qv = embed_one(query)
     D, I = index.search(qv, oversample)
@@ -103,64 +269,75 @@ def search_docs_top_chunks(index_dir, query, k_docs=5, chunks_per_doc=2, oversam
     qwords = informative_qwords(query)
     need = len(qwords)
 
-    per_doc = {}
-    for j in range(oversample):
-        idx = int(I[0][j])
-        base = float(D[0][j])
-        m = meta[idx]
-        doc = m["source_path"]
+    ids = I[0]
+    ok = ids >= 0  # HNSW/IVF pueden devolver menos de oversample resultados
+    sel = ids[ok]
+    if len(sel) == 0:
+        return []
+    docs = meta["source_path"][sel]
+    tns = meta["text_norm"][sel].tolist()
+    scores, hits = rerank_scores(D[0][ok], tns, qwords)
+
+    # groupby por doc: código por chunk + primera aparición (desempate entre docs)
+    _, first, inv = np.unique(docs, return_index=True, return_inverse=True)
+    n = len(sel)
+
+    # prioridad por cobertura de qwords: tier 0 = hits >= need (ej. 2/2), 1 = hits = need-1 (ej. 1/2), 2 = resto;
+    # cada doc usa solo su mejor tier
+    if need > 0:
+        tier = np.where(hits >= need, 0, np.where(hits == need - 1, 1, 2))
+    else:
+        tier = np.full(n, 2)
+    best = np.full(len(first), 2)
+    np.minimum.at(best, inv, tier)
 
-        score, hits = rerank_score(base, m["text"], qwords)
-        per_doc.setdefault(doc, [])
-        per_doc[doc].append((score, hits, m))
+    # chunks agrupados por doc, score desc, posición FAISS como desempate (= sort estable)
+    order = np.lexsort((np.arange(n), -scores, inv))
+    order = order[tier[order] == best[inv[order]]]
+    starts = np.flatnonzero(np.r_[True, inv[order][1:] != inv[order][:-1]])
+    ends = np.r_[starts[1:], len(order)]
 
+    # doc_score = mejor chunk del tier elegido; docs por score desc y luego orden de aparición
+    doc_score = scores[order[starts]]
     doc_items = []
-    for doc, lst in per_doc.items():
-        # ordenar por score
-        lst.sort(key=lambda x: x[0], reverse=True)
-
-        # prioridad por cobertura de qwords
-        if need > 0:
-            full = [x for x in lst if x[1] >= need]          # hits >= need (ej. 2/2)
-            partial = [x for x in lst if x[1] == need - 1]   # hits = need-1 (ej. 1/2)
-        else:
-            full, partial = [], []
-
-        if full:
-            doc_score = full[0][0]
-            top_chunks = full[:chunks_per_doc]
-        elif partial:
-            doc_score = partial[0][0]
-            top_chunks = partial[:chunks_per_doc]
-        else:
-            doc_score = lst[0][0]
-            top_chunks = lst[:chunks_per_doc]
-
-        doc_items.append((doc_score, doc, top_chunks, qwords))
-
-    doc_items.sort(key=lambda x: x[0], reverse=True)
-    return doc_items[:k_docs]
+    for g in np.lexsort((first, -doc_score))[:k_docs]:
+        top = order[starts[g]:min(ends[g], starts[g] + chunks_per_doc)]
+        top_chunks = [(float(scores[j]), int(hits[j]), meta_row(meta, int(sel[j]))) for j in top]
+        doc_items.append((float(doc_score[g]), docs[first[g]], top_chunks, qwords))
+    return doc_items
 
 def query_with_fallback(query: str,
                         hq_dir="Francisco/docling_test5_hq",
                         all_dir="Francisco/docling_test5_all",
-                        k_docs=5, chunks_per_doc=2):
-    res_hq = search_docs_top_chunks(hq_dir, query, k_docs=k_docs, chunks_per_doc=chunks_per_doc, oversample=400)
+                        k_docs=5, chunks_per_doc=2, use_gpu=False):
+    res_hq = search_docs_top_chunks(hq_dir, query, k_docs=k_docs, chunks_per_doc=chunks_per_doc, oversample=400,
+                                    use_gpu=use_gpu)
     
     # criterio simple: si el top HQ es muy bajo, intenta ALL
     if (not res_hq) or (res_hq[0][0] < 0.45):
-        res_all = search_docs_top_chunks(all_dir, query, k_docs=k_docs, chunks_per_doc=chunks_per_doc, oversample=700)
+        res_all = search_docs_top_chunks(all_dir, query, k_docs=k_docs, chunks_per_doc=chunks_per_doc, oversample=700,
+                                         use_gpu=use_gpu)
         return "ALL", res_all
     return "HQ", res_hq
 
 # ---- run ----
-q = "crisis política en ecuador 2001"
-which, res = query_with_fallback(q, k_docs=5, chunks_per_doc=2)
-
-print(f"{which} (docs, top chunks) — reranked:")
-for doc_score, doc, chunks, qwords in res:
-    print("\n===", doc, "doc_score:", doc_score, "| qwords:", qwords)
-    for s, hits, m in chunks:
-        preview = m["text"][:500].replace("\n", " ")
-        print(" ", f"score={s:.4f}", f"hits={hits}", m["id"])
-        print("    ", preview, "...")
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("query", nargs="?", default="crisis política en ecuador 2001")
+    ap.add_argument("--hq-dir", default="Francisco/docling_test5_hq")
+    ap.add_argument("--all-dir", default="Francisco/docling_test5_all")
+    ap.add_argument("--k-docs", type=int, default=5)
+    ap.add_argument("--chunks-per-doc", type=int, default=2)
+    ap.add_argument("--use-gpu", action="store_true", help="Mover el índice FAISS a GPU (si faiss-gpu está disponible)")
+    args = ap.parse_args()
+
+    which, res = query_with_fallback(args.query, hq_dir=args.hq_dir, all_dir=args.all_dir,
+                                     k_docs=args.k_docs, chunks_per_doc=args.chunks_per_doc, use_gpu=args.use_gpu)
+
+    print(f"{which} (docs, top chunks) — reranked:")
+    for doc_score, doc, chunks, qwords in res:
+        print("\n===", doc, "doc_score:", doc_score, "| qwords:", qwords)
+        for s, hits, m in chunks:
+            preview = m["text"][:500].replace("\n", " ")
+            print(" ", f"score={s:.4f}", f"hits={hits}", m["id"])
+            print("    ", preview, "...")